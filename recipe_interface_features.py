@@ -1,70 +1,276 @@
 import streamlit as st
 import requests
 import json
-from fpdf import FPDF  # PDF generation
+import collections
+import orjson
+import diskcache
+import functools
+import hashlib
+import threading
+import re
+from concurrent.futures import Future
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from io import BytesIO
+from xml.sax.saxutils import escape
+from reportlab.lib.pagesizes import A4  # PDF generation
+from reportlab.lib.styles import getSampleStyleSheet
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
 
 # Constants
 API_URL = "https://openrouter.ai/api/v1/chat/completions"
 API_KEY = st.secrets["OPENROUTER_API_KEY"]
+CACHE_DIR = "./.recipe_cache"
+DEBUG = bool(st.secrets.get("DEBUG", False))  # developer-only output
+MAX_TURNS = 6  # follow-up exchanges kept in the conversation sent to the model
 
-# Cached AI call to avoid duplicate requests
-@st.cache_data(show_spinner=False)
-def get_meal_suggestions(messages):
-    headers = {
-        "Authorization": f"Bearer {API_KEY}",
-        "Content-Type": "application/json",
-        "X-Title": "Recipe Meal Planner"
-    }
-    data = {
+# Recipe prompt, filled in from the form fields on submit
+_PROMPT_TEMPLATE = """\
+You are a helpful and knowledgeable meal planning assistant with many years of experience in several types of cousine.
+You will generate a tailored recipe based on the user preferences and needs stated below
+Ingredients that user currently has: {ingredients}
+The kind of meal the user wants to cook: {meal_type}
+Dietary Needs: {dietary_needs}
+Preparation Time Preference: {prep_time} minutes
+If the user answers 'yes' for this question, they want a nutritional breakdown of the meal so also include the info in the recipe, if they answered 'no', you don't display that info: {nutritional_breakdown}
+Portion size the user wants to cook: {portion_size}
+Tools the user does not have available: {tools}
+Additional Preferences of the user: {additional_preferences}
+When listing ingredients, make sure to always use metric system i.e. grams, liters, etc. NOT imperial system.
+You may use extra ingredients if needed, but clearly list them at the end under a section titled '🛒 Shopping List'.
+Clearly structure your response like this, each point being a separate headline:
+1. Recipe title (as a top-level Markdown heading, # Title)
+2. Preparation time of the meal (## Preparation Time)
+3. Ingredients List (including both user's and extra ones as subheading ## Ingredients)
+4. Any special tools they need but might not have (## Tools)
+5. Step-by-step instructions (## Instructions)
+6. 🛒 Shopping List (only the ingredients the user didn't provide, under ## Shopping List)
+At the end, add a friendly sign-off like 'Enjoy your meal!' or 'Bon Appétit!'."""
+
+# Shared HTTP session so follow-up calls reuse the pooled TLS connection.
+# Cached as a resource: it must survive reruns and is shared, not copied, per caller.
+@st.cache_resource
+def _http_session():
+    session = requests.Session()
+    retries = Retry(
+        total=3,
+        read=0,  # a read timeout means the model was generating; don't re-bill it
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["POST"]
+    )
+    session.mount("https://", HTTPAdapter(pool_connections=20, pool_maxsize=20, max_retries=retries))
+    return session
+
+HEADERS = {
+    "Authorization": f"Bearer {API_KEY}",
+    "Content-Type": "application/json",
+    "X-Title": "Recipe Meal Planner"
+}
+
+def _request_data(messages, stream=False):
+    return {
         "model": "meta-llama/llama-4-maverick:free",
         "messages": messages,
-        "max_tokens": 600
+        "max_tokens": 600,
+        "stream": stream
     }
 
-    resp = requests.post(API_URL, json=data, headers=headers)
+# LLM lookup/network counters for the debug panel, shared across sessions
+@st.cache_resource
+def _cache_stats():
+    return collections.Counter(), threading.Lock()
+
+def _count(name):
+    stats, lock = _cache_stats()
+    with lock:
+        stats[name] += 1
+
+def _counted(name):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            _count(name)
+            return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# On-disk response cache, so answers outlive a server restart
+@st.cache_resource
+def _disk_cache():
+    return diskcache.Cache(CACHE_DIR, size_limit=int(1e9))
+
+# Requests currently on the wire, shared across sessions of this process
+@st.cache_resource
+def _inflight():
+    return {}, threading.Lock()
+
+# Key on the whole request (model, max_tokens, ...) so the disk cache never
+# serves answers produced under older settings; stream mode doesn't change the answer
+def _messages_key(messages):
+    payload = _request_data(messages)
+    del payload["stream"]
+    return hashlib.blake2b(json.dumps(payload, sort_keys=True).encode(), digest_size=16).hexdigest()
+
+# Single non-streamed completion request
+@_counted("network")
+def _post_chat(messages):
+    resp = _http_session().post(API_URL, json=_request_data(messages), headers=HEADERS, timeout=(5, 120))
     resp.raise_for_status()
-    return resp.json()["choices"][0]["message"]["content"]
+    return orjson.loads(resp.content)["choices"][0]["message"]["content"]
 
-# PDF creation of saved recipes
-def create_pdf(title: str, content: str) -> bytes:
-    safe_title   = title.encode("latin-1", "ignore").decode("latin-1")
-    safe_content = content.encode("latin-1", "ignore").decode("latin-1")
+# Cached AI call to avoid duplicate requests (memory first, then disk).
+# st.cache_data already makes identical concurrent misses wait for one computation.
+@st.cache_data(show_spinner=False)
+def _cached_meal_suggestions(messages):
+    key = _messages_key(messages)
+    cache = _disk_cache()
+    content = cache.get(key)
+    if content is None:
+        content = _post_chat(messages)
+        cache[key] = content
+    return content
+
+# Counted outside the cache layers, so lookups minus network calls = hits
+@_counted("lookups")
+def get_meal_suggestions(messages):
+    return _cached_meal_suggestions(messages)
 
-    pdf = FPDF()
-    pdf.add_page()
-    pdf.set_font("Arial", "B", 18)
-    pdf.cell(0, 10, safe_title, ln=1, align="C")
-    pdf.ln(4)
+# Streamed completion request: yields content deltas, returns the full text.
+# Raises unless the model finished cleanly, so a partial answer is never kept.
+def _stream_chat(messages):
+    _count("network")
+    parts = []
+    finish_reason = None
+    with _http_session().post(API_URL, json=_request_data(messages, stream=True), headers=HEADERS,
+                      timeout=(5, 120), stream=True) as resp:
+        resp.raise_for_status()
+        for raw in resp.iter_lines():
+            # skip keep-alive blanks and ": OPENROUTER PROCESSING" comments
+            if not raw or not raw.startswith(b"data: "):
+                continue
+            payload = raw[6:]
+            if payload == b"[DONE]":
+                break
+            event = orjson.loads(payload)
+            choice = (event.get("choices") or [{}])[0]
+            finish_reason = choice.get("finish_reason") or finish_reason
+            # mid-stream failures arrive as an error event, not an HTTP status
+            if "error" in event or finish_reason == "error":
+                error = event.get("error") or {}
+                raise RuntimeError(f"OpenRouter stream failed: {error.get('message', 'unknown error')}")
+            delta = choice.get("delta", {}).get("content", "")
+            if delta:
+                parts.append(delta)
+                yield delta
 
-    for line in safe_content.splitlines():
+    # a dropped connection, content filter or missing finish_reason means an incomplete answer
+    if finish_reason not in ("stop", "length"):
+        raise RuntimeError(f"OpenRouter stream ended early (finish_reason: {finish_reason})")
+    return "".join(parts)
+
+# Streamed AI call: yields content deltas from the SSE response as they arrive.
+# Identical concurrent submits wait on the first caller's future instead of re-posting.
+@_counted("lookups")
+def stream_meal_suggestions(messages):
+    key = _messages_key(messages)
+    cache = _disk_cache()
+    cached = cache.get(key)
+    if cached is not None:
+        yield cached
+        return
+
+    inflight, lock = _inflight()
+    with lock:
+        fut = inflight.get(key)
+        owner = fut is None
+        if owner:
+            fut = inflight[key] = Future()
+    if not owner:
+        yield fut.result()
+        return
+
+    try:
+        content = yield from _stream_chat(messages)
+        fut.set_result(content)
+    except BaseException as e:
+        # also covers GeneratorExit when the consumer stops early, so waiters never hang
+        fut.set_exception(e if isinstance(e, Exception) else RuntimeError("Identical request was cancelled"))
+        raise
+    finally:
+        with lock:
+            inflight.pop(key, None)
+
+    cache[key] = content
+
+# Recipe title = first non-empty line without its heading marks
+def _extract_title(response: str) -> str:
+    for line in response.splitlines():
+        text = line.lstrip("#").strip()
+        if text:
+            return text
+    return "Untitled Recipe"
+
+# Keep the seed prompt and its recipe, the last MAX_TURNS user/assistant exchanges
+# and the new user turn (called right after that turn is appended)
+def _trim_messages():
+    msgs = st.session_state.messages
+    if len(msgs) > 3 + 2 * MAX_TURNS:
+        st.session_state.messages = msgs[:2] + msgs[-(2 * MAX_TURNS + 1):]
+
+# Markdown heading level -> reportlab paragraph style
+_HEAD_RE = re.compile(r"^(#{1,3})\s+(.+)$")
+_HEAD_STYLE = {1: "Heading1", 2: "Heading2", 3: "Heading3"}
+
+# reportlab's built-in Helvetica only covers cp1252; drop what it can't draw
+# (emoji like 🛒 would otherwise render as black boxes) and escape markup
+def _pdf_text(text: str) -> str:
+    if not text.isascii():
+        text = text.encode("cp1252", "ignore").decode("cp1252").strip()
+    return escape(text)
+
+# Paragraph styles are built once per process and shared by every PDF
+@st.cache_resource
+def _pdf_styles():
+    return getSampleStyleSheet()
+
+# PDF creation of saved recipes, cached so reruns don't rebuild every saved PDF
+@st.cache_data(show_spinner=False, max_entries=128)
+def create_pdf(title: str, content: str) -> bytes:
+    styles = _pdf_styles()
+    story = [Paragraph(_pdf_text(title), styles["Title"]), Spacer(1, 12)]
+
+    for line in content.splitlines():
         text = line.strip()
         if not text:
-            pdf.ln(2)
+            story.append(Spacer(1, 6))
             continue
-        if text.startswith("# "):
-            heading = text[2:].strip()
-            pdf.set_font("Arial", "B", 16)
-            pdf.cell(0, 10, heading, ln=1)
-        elif text.startswith("## "):
-            heading = text[3:].strip()
-            pdf.set_font("Arial", "B", 14)
-            pdf.cell(0, 8, heading, ln=1)
-        elif text.startswith("### "):
-            heading = text[4:].strip()
-            pdf.set_font("Arial", "B", 12)
-            pdf.cell(0, 8, heading, ln=1)
+        match = _HEAD_RE.match(text)
+        if match:
+            style = styles[_HEAD_STYLE[len(match.group(1))]]
+            story.append(Paragraph(_pdf_text(match.group(2)), style))
         else:
-            pdf.set_font("Arial", "", 12)
-            pdf.multi_cell(0, 6, text)
+            story.append(Paragraph(_pdf_text(text), styles["BodyText"]))
 
-    return pdf.output(dest="S").encode("latin-1")
+    buf = BytesIO()
+    SimpleDocTemplate(buf, pagesize=A4).build(story)
+    return buf.getvalue()
 
 
-# Session state init
-for key in ["history", "saved", "latest_recipe", "latest_prompt",
-            "messages", "substitute_mode", "ingredient_to_sub"]:
-    if key not in st.session_state:
-        st.session_state[key] = "" if "recipe" in key or "prompt" in key else []
+# Session state init (once per session)
+_DEFAULTS = {
+    "history": [],
+    "saved": [],
+    "latest_recipe": "",
+    "latest_title": "",
+    "latest_prompt": "",
+    "messages": [],
+    "substitute_mode": False,
+    "ingredient_to_sub": ""
+}
+if "_initialized" not in st.session_state:
+    st.session_state.update(_DEFAULTS)
+    st.session_state["_initialized"] = True
 
 # UI Setup
 st.set_page_config(page_title="🍽️ AI Meal Planner", layout="wide")
@@ -74,11 +280,19 @@ st.subheader("Use the tabs below to generate or view saved recipes.")
 # Sidebar: recipe history titles
 st.sidebar.title("📜 Recipe History")
 if st.session_state.history:
-    for i, title in enumerate(reversed(st.session_state.history)):
-        st.sidebar.markdown(f"**{len(st.session_state.history) - i}.** {title}")
+    # one markdown element for the whole list instead of one per title
+    n = len(st.session_state.history)
+    lines = [f"**{n - i}.** {title}" for i, title in enumerate(reversed(st.session_state.history))]
+    st.sidebar.markdown("\n\n".join(lines))
 else:
     st.sidebar.info("No recipes yet.")
 
+# The caches are shared by every session, so only developers may wipe them
+if DEBUG and st.sidebar.button("🧹 Clear response cache"):
+    _disk_cache().clear()
+    _cached_meal_suggestions.clear()
+    st.sidebar.success("Cache cleared.")
+
 # Two tabs: Generator & Saved
 tab1, tab2 = st.tabs(["Recipe Generator", "Saved Recipes"])
 
@@ -100,42 +314,33 @@ with tab1:
         
         submitted = st.form_submit_button("Get Meal Suggestion")
 
+    streamed = False
     if submitted:
-        user_prompt = (
-            "You are a helpful and knowledgeable meal planning assistant with many years of experience in several types of cousine.\n"
-            f"You will generate a tailored recipe based on the user preferences and needs stated below\n"
-            f"Ingredients that user currently has: {ingredients}\n"
-            f"The kind of meal the user wants to cook: {meal_type}\n"
-            f"Dietary Needs: {dietary_needs}\n"
-            f"Preparation Time Preference: {prep_time} minutes\n"
-            f"If the user answers 'yes' for this question, they want a nutritional breakdown of the meal so also include the info in the recipe, if they answered 'no', you don't display that info: {nutritional_breakdown}\n"
-            f"Portion size the user wants to cook: {portion_size}\n"
-            f"Tools the user does not have available: {tools}\n"
-            f"Additional Preferences of the user: {additional_preferences}\n"
-            f"When listing ingredients, make sure to always use metric system i.e. grams, liters, etc. NOT imperial system.\n"
-            f"You may use extra ingredients if needed, but clearly list them at the end under a section titled '🛒 Shopping List'.\n"
-            f"Clearly structure your response like this, each point being a separate headline:\n"
-            f"1. Recipe title (as a top-level Markdown heading, # Title)\n"
-            f"2. Preparation time of the meal (## Preparation Time)\n"
-            f"3. Ingredients List (including both user's and extra ones as subheading ## Ingredients)\n"
-            f"4. Any special tools they need but might not have (## Tools)\n"
-            f"5. Step-by-step instructions (## Instructions)\n"
-            f"6. 🛒 Shopping List (only the ingredients the user didn't provide, under ## Shopping List)\n"
-            f"At the end, add a friendly sign-off like 'Enjoy your meal!' or 'Bon Appétit!'."
+        user_prompt = _PROMPT_TEMPLATE.format(
+            ingredients=ingredients,
+            meal_type=meal_type,
+            dietary_needs=dietary_needs,
+            prep_time=prep_time,
+            nutritional_breakdown=nutritional_breakdown,
+            portion_size=portion_size,
+            tools=tools,
+            additional_preferences=additional_preferences
         )
 
         messages = [{"role": "user", "content": user_prompt}]
 
+        placeholder = st.empty()
         with st.spinner("🍳 Cooking up ideas..."):
             try:
-                response = get_meal_suggestions(messages)
+                # render tokens as they stream in, then keep the joined text
+                buf = []
+                for token in stream_meal_suggestions(messages):
+                    buf.append(token)
+                    placeholder.markdown("### 🍽️ Your Meal Suggestion\n\n" + "".join(buf))
+                response = "".join(buf)
                 st.session_state.latest_recipe = response
-
-                # extract title
-                title = next(
-                    (line.strip('# ').strip() for line in response.splitlines() if line.strip()),
-                    "Untitled Recipe"
-                )
+                st.session_state.latest_title  = _extract_title(response)
+                streamed = True
 
                 # store context & history
                 st.session_state.latest_prompt = user_prompt
@@ -143,30 +348,38 @@ with tab1:
                     {"role": "user", "content": user_prompt},
                     {"role": "assistant", "content": response}
                 ]
-                st.session_state.history.append(title)
+                st.session_state.history.append(st.session_state.latest_title)
             except Exception as e:
+                # drop the partial output; the previous recipe (if any) renders below
+                placeholder.empty()
                 st.error(f"Error: {e}")
 
     # Display the generated recipe
     if st.session_state.latest_recipe:
-        st.markdown("### 🍽️ Your Meal Suggestion")
-        st.write(st.session_state.latest_recipe)
+        # already rendered by the stream on the submitting run
+        if not streamed:
+            st.markdown("### 🍽️ Your Meal Suggestion")
+            st.write(st.session_state.latest_recipe)
 
         # Substitution feature
         with st.expander("🔁 Ingredient Substitution"):
             st.session_state.substitute_mode = st.checkbox("I want to substitute an ingredient")
             if st.session_state.substitute_mode:
-                st.session_state.ingredient_to_sub = st.text_input("Which ingredient would you like to substitute?")
-                if st.button("Suggest Alternatives") and st.session_state.ingredient_to_sub:
+                st.session_state.ingredient_to_sub = st.text_input("Which ingredients would you like to substitute? (comma-separated)")
+                items = [s.strip() for s in st.session_state.ingredient_to_sub.split(",") if s.strip()]
+                if st.button("Suggest Alternatives") and items:
+                    # all ingredients go out in a single request
                     st.session_state.messages.append({
                         "role": "user",
-                        "content": f"I would like to substitute '{st.session_state.ingredient_to_sub}'. "
-                                   "Can you suggest 2–3 alternatives and explain why?"
+                        "content": "Suggest 2–3 alternatives (with reasoning) for each of: "
+                                   + ", ".join(items)
+                                   + ". Give each ingredient its own '## <ingredient>' Markdown section."
                     })
+                    _trim_messages()
                     try:
                         sub_resp = get_meal_suggestions(st.session_state.messages)
                         st.session_state.messages.append({"role": "assistant", "content": sub_resp})
-                        st.markdown(f"### 🔄 Substitution for '{st.session_state.ingredient_to_sub}'")
+                        st.markdown("### 🔄 Substitution for " + ", ".join(f"'{i}'" for i in items))
                         st.write(sub_resp)
                     except Exception as e:
                         st.error(f"Error during substitution: {e}")
@@ -174,7 +387,7 @@ with tab1:
         # Sav Recipe feature
         if st.button("💾 Save this recipe"):
             st.session_state.saved.append({
-                "title": title,
+                "title": st.session_state.latest_title,
                 "content": st.session_state.latest_recipe
             })
             st.success("Recipe saved to your library!")
@@ -185,17 +398,14 @@ with tab1:
                 "role": "user",
                 "content": "I didn't like the previous recipe. Please generate a new one."
             })
+            _trim_messages()
             with st.spinner("🌀 Generating a new recipe..."):
                 try:
                     new_resp = get_meal_suggestions(st.session_state.messages)
                     st.session_state.messages.append({"role": "assistant", "content": new_resp})
                     st.session_state.latest_recipe = new_resp
-                    # extract & save new title
-                    new_title = next(
-                        (ln.strip('# ').strip() for ln in new_resp.splitlines() if ln.strip()),
-                        "Untitled Recipe"
-                    )
-                    st.session_state.history.append(new_title)
+                    st.session_state.latest_title  = _extract_title(new_resp)
+                    st.session_state.history.append(st.session_state.latest_title)
                 except Exception as e:
                     st.error(f"Error regenerating recipe: {e}")
 
@@ -215,3 +425,12 @@ with tab2:
                 mime="application/pdf",
                 key=f"pdf_{idx}"
             )
+
+# Drawn last so the numbers include this run's LLM calls
+if DEBUG:
+    with st.sidebar.expander("📊 LLM cache stats"):
+        stats, _ = _cache_stats()
+        lookups, network = stats["lookups"], stats["network"]
+        hits = max(lookups - network, 0)
+        st.metric("LLM cache hit rate", f"{hits / lookups:.0%}" if lookups else "n/a")
+        st.caption(f"{lookups} lookups · {hits} hits · {network} network calls")